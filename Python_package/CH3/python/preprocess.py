@@ -2,18 +2,114 @@
 # For license information, see LICENSE.TXT
 
 
-import sys
 import os
-import pyreadr
+import math
 import pandas as pd
 import numpy as np
-from scipy.stats import norm
-from sklearn import preprocessing
+import re
+import glob
+import hashlib
+import shutil
+import tempfile
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pv
+import pyarrow.parquet as pq
+from concurrent.futures import ThreadPoolExecutor
+from numba import njit, prange
+from scipy.special import erfinv
 
 from CH3.python.illuminaio import list_idat
 
 
-def preprocess(probes_file, controls_file, idat_files_folder, min_beads=3, detection=0.05, return_intensities=False, return_snps_r=False):
+# version of the cached outputs, part of the cache key: bump it whenever a change
+# alters the outputs for identical inputs, so stale caches are not reused
+CACHE_VERSION = 3
+
+
+# control beads with a unique description that are reported as is in the summary:
+# description -> (summary row, channel)
+DESC_TO_ROW = {'Extension (A)': ('ext_a', 'red'), 'Extension (C)': ('ext_c', 'grn'),
+               'Extension (G)': ('ext_g', 'grn'), 'Extension (T)': ('ext_t', 'red'),
+               'Hyb (Low)': ('hyp_low', 'grn'), 'Hyb (Medium)': ('hyp_med', 'grn'),
+               'Hyb (High)': ('hyp_high', 'grn'),
+               'NP (A)': ('np_a', 'red'), 'NP (C)': ('np_c', 'grn'),
+               'NP (G)': ('np_g', 'grn'), 'NP (T)': ('np_t', 'red')}
+
+
+def csv_to_parquet(csv_file):
+    """
+    Converts a beads .csv file into a zstd-compressed .parquet file next to it
+
+    Parameters
+    -----------
+        csv_file (path): path to a '*_beads.csv' file
+
+    Returns
+    --------
+        path to the written '*_beads.parquet' file
+    """
+
+    table = pv.read_csv(csv_file, convert_options=pv.ConvertOptions(column_types={
+        '': pa.int64(),
+        'grn.n': pa.int32(), 'grn.mean': pa.float32(), 'grn.sd': pa.float32(),
+        'red.n': pa.int32(), 'red.mean': pa.float32(), 'red.sd': pa.float32()}))
+    table = table.rename_columns(['probe_address', 'grn_n', 'grn_mean', 'grn_sd', 'red_n', 'red_mean', 'red_sd'])
+
+    # written to a temporary file next to it and renamed once complete, so an
+    # interrupted conversion never leaves a truncated .parquet file behind
+    parquet_file = os.path.splitext(csv_file)[0] + '.parquet'
+    fd, tmp_file = tempfile.mkstemp(prefix=os.path.basename(parquet_file) + '.', suffix='.tmp',
+                                    dir=os.path.dirname(parquet_file) or '.')
+    os.close(fd)
+    try:
+        pq.write_table(table, tmp_file, compression='zstd')
+        os.replace(tmp_file, parquet_file)
+    finally:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+
+    return parquet_file
+
+
+@njit(parallel=True, cache=True)
+def correct_intensities(A, B, rows, neg_means_a, neg_means_b, threshold, corrections_a, corrections_b):
+    """
+    Censors probes below the detection limit, subtracts the background and corrects the dye bias in place
+
+    Parameters
+    -----------
+        A (array): (probes x samples) unmethylated intensities, modified in place
+        B (array): (probes x samples) methylated intensities, modified in place
+        rows (array): row positions of the probes of one type
+        neg_means_a (array): mean intensity of the negative control beads per sample, in the channel of A
+        neg_means_b (array): mean intensity of the negative control beads per sample, in the channel of B
+        threshold (array): detection threshold of the total intensity A + B per sample
+        corrections_a (array): dye bias correction per sample applied to A
+        corrections_b (array): dye bias correction per sample applied to B
+    """
+
+    # a single pass over the rows: the total intensity is formed on the fly and
+    # no temporary arrays or masks are materialised (no fastmath, NaNs are meaningful)
+    for k in prange(len(rows)):
+        r = rows[k]
+        for j in range(A.shape[1]):
+            a = A[r, j]
+            b = B[r, j]
+            detected = a + b > threshold[j]
+
+            if detected and a > neg_means_a[j]:
+                A[r, j] = (a - neg_means_a[j]) * corrections_a[j]
+            else:
+                A[r, j] = np.nan
+
+            if detected and b > neg_means_b[j]:
+                B[r, j] = (b - neg_means_b[j]) * corrections_b[j]
+            else:
+                B[r, j] = np.nan
+
+
+def preprocess(probes_file, controls_file, idat_files_folder, min_beads=3, detection=0.05, return_intensities=False, return_snps_r=False, beads_folder='CH3/python/dnam', cache_dir=None):
     """
     Preprocesses Illumina Infinium DNA methylation bead chips
 
@@ -29,6 +125,8 @@ def preprocess(probes_file, controls_file, idat_files_folder, min_beads=3, detec
         detection (float, optional): p-value for probe-detection, probes that aren't significantly different from negative control beads are censored (default 0.05)
         return_intensities (bool, optional): returns four (large) matrices containing preprocessed intensities: intensities_A, intensities_B and controls_red, controls_grn
         return_snps_r (bool, optional): returns matrix containing SNP r-coordinate in polar coordinate system
+        beads_folder (path, optional): path to folder containing the parsed beads of each sample as '*_beads.csv' files, these are cached as '*_beads.parquet' on first use (default 'CH3/python/dnam')
+        cache_dir (path, optional): folder in which the preprocessed outputs are cached as .parquet files, keyed by the input files and arguments; repeated calls with unchanged inputs are read from there (default None, no caching)
         verbose (bool, optional): prints timestamp per sample and overall time taken
 
     Returns
@@ -58,6 +156,8 @@ def preprocess(probes_file, controls_file, idat_files_folder, min_beads=3, detec
             'detection': detection
             'return_intensities': return_intensities
             'return_snps_r': return_snps_r
+            'beads_folder': beads_folder
+            'cache_dir': cache_dir
             'verbose': verbose
 
         }
@@ -70,214 +170,253 @@ def preprocess(probes_file, controls_file, idat_files_folder, min_beads=3, detec
 
 
     def load_data(csv_file):
-        data = pd.read_csv(csv_file)
-        data.columns = ['probe_address', 'grn_n', 'grn_mean', 'grn_sd', 'red_n', 'red_mean', 'red_sd']
-        data.set_index(['probe_address'], inplace=True)
-        return data
+        parquet_file = os.path.splitext(csv_file)[0] + '.parquet'
+        if not os.path.exists(parquet_file) or os.path.getmtime(parquet_file) < os.path.getmtime(csv_file):
+            csv_to_parquet(csv_file)
 
-    def read_manifests(probes_file, controls_file):
-        #result_p = pyreadr.read_r(probes_file)
-        #probes = pd.DataFrame((result_p[None])) #columns=['chr', 'pos', 'type', 'address_a', 'address_b'])
+        # the typed columns are read without pandas and returned as numpy arrays
+        # (no type conversion, they are already int32 / float32)
+        table = pq.read_table(parquet_file, columns=['probe_address', 'grn_n', 'grn_mean', 'red_n', 'red_mean'])
+        return {name: column.to_numpy() for name, column in zip(table.column_names, table.columns)}
 
-        #result_c = pyreadr.read_r(controls_file)
-        #controls = pd.DataFrame((result_c[None])) #columns=['type', 'color', 'description', 'comment'])
-        
+    def read_manifests(probes_file, controls_file):
         ## temporary solution (pyreader does not recognise the index labels)
-        controls = pd.read_csv(controls_file, low_memory=True)
-        controls.set_index(['Unnamed: 0'], inplace=True)
+        ## parsed with pyarrow using fixed column types,
+        ## the repeatedly filtered 'type' and 'description' columns are read as categoricals
+        category = pa.dictionary(pa.int32(), pa.string())
+
+        controls = pv.read_csv(controls_file, convert_options=pv.ConvertOptions(column_types={
+            '': pa.int64(), 'type': category, 'color': pa.string(),
+            'description': category, 'comment': pa.string()})).to_pandas()
+        controls.set_index([''], inplace=True)
         controls.index.names = ['sample_id']
 
-        probes = pd.read_csv(probes_file, low_memory=True)
-        probes.set_index(['Unnamed: 0'], inplace=True)
+        # (pandas guesses mixed types for 'chr')
+        probes = pv.read_csv(probes_file, convert_options=pv.ConvertOptions(column_types={
+            '': pa.string(), 'chr': pa.string(), 'pos': pa.int64(), 'type': category,
+            'address.a': pa.int64(), 'address.b': pa.int64()}))
+
+        # SNP probes are named with the prefix "rs" ('rs10796216', 'rs715359',..),
+        # the mask is computed once on the arrow column of probe names
+        is_snp = pc.starts_with(probes.column(''), 'rs').to_numpy()
+
+        probes = probes.to_pandas()
+        probes.set_index([''], inplace=True)
         probes.index.names = ['probe_address']
         
-        return probes, controls
+        return probes, controls, is_snp
 
+    def collect(results):
+        samples = results['summary'].T
+        cpgs = results['dnam'].T
+        snps = results['snps_theta'].T
 
-    ### quick solution - needs to be removed in final package
+        if return_intensities == True:
+            return samples, cpgs, snps, results['intensities_A'], results['intensities_B'], results['controls_red'], results['controls_grn']
 
-    beads5 = 'CH3/python/dnam/R05C01_beads.csv'
-    beads4 = 'CH3/python/dnam/R04C01_beads.csv'
-    beads3 = 'CH3/python/dnam/R03C01_beads.csv'
-    beads2 = 'CH3/python/dnam/R02C01_beads.csv'
-    beads1 = 'CH3/python/dnam/R01C01_beads.csv'
+        elif return_snps_r == True:
 
+            return results['snps_r'].T
 
-    data1 = load_data(beads1)
-    data2 = load_data(beads2)
-    data3 = load_data(beads3)
-    data4 = load_data(beads4)
-    data5 = load_data(beads5)
+        else:
+            return samples, cpgs, snps
 
-    data_list = [data1, data2, data3, data4, data5]
 
-    probes, controls = read_manifests(probes_file, controls_file)
+    bead_files = sorted(glob.glob(os.path.join(beads_folder, '*_beads.csv')))
 
+    ## outputs are deterministic in the input files and arguments, reuse them if cached
+    result_names = ['summary', 'dnam', 'snps_theta', 'snps_r', 'intensities_A', 'intensities_B', 'controls_red', 'controls_grn']
+
+    if cache_dir is not None:
+        input_files = [probes_file, controls_file] + bead_files + sorted(glob.glob(idat_files_folder + "/*.idat"))
+        key = hashlib.sha1(repr([(os.path.abspath(f), os.stat(f).st_mtime_ns, os.stat(f).st_size) for f in input_files]
+                                + [min_beads, detection, CACHE_VERSION]).encode()).hexdigest()
+        cache_path = os.path.join(os.path.expanduser(cache_dir), key)
+
+        if all(os.path.exists(os.path.join(cache_path, name + '.parquet')) for name in result_names):
+            return collect({name: pd.read_parquet(os.path.join(cache_path, name + '.parquet')) for name in result_names})
 
-    ## preparation of outputs
-    inf1grn = probes[probes['type'] == "I-Grn"]
-    inf1red = probes[probes['type'] == "I-Red"]
-    inf2 = probes[probes['type'] == "II"]
     idat_files = list_idat(idat_files_folder)
+    sample_ids = np.sort(pd.unique(idat_files['sample.id']))
 
-    ## create intensities
-    ## create empty dataframes to append to
-    intensities_A = pd.DataFrame(np.nan, index=probes.index, columns=np.sort(pd.unique(idat_files['sample.id'])))
-    intensities_B = pd.DataFrame(np.nan, index=probes.index, columns=np.sort(pd.unique(idat_files['sample.id'])))
+    ## match every sample to its bead file through the file name: by the full sample id
+    ## (chip_position, e.g. 7800246024_R01C01) when the name contains it, otherwise by the
+    ## array position alone (e.g. R01C01), which is only unambiguous for a single chip
+    bead_map = {}
+    for bead_file in bead_files:
+        match = re.search(r'(\d+_)?R\d+C\d+', os.path.basename(bead_file))
+        if match is None:
+            raise ValueError("no array position in the name of bead file %s" % bead_file)
+        if match.group() in bead_map:
+            raise ValueError("bead files %s and %s both match %s" % (bead_map[match.group()], bead_file, match.group()))
+        bead_map[match.group()] = bead_file
+
+    sample_positions = dict(zip(idat_files['sample.id'], idat_files['position']))
+    position_counts = pd.Series(sample_positions).value_counts()
+
+    sample_bead_files = []
+    for sample_id in sample_ids:
+        position = sample_positions[sample_id]
+        if sample_id in bead_map:
+            sample_bead_files.append(bead_map[sample_id])
+        elif position_counts[position] > 1:
+            raise ValueError("samples from several chips share the array position %s, "
+                             "name their bead files by sample id (e.g. %s_beads.csv)" % (position, sample_id))
+        elif position in bead_map:
+            sample_bead_files.append(bead_map[position])
+        else:
+            raise ValueError("no bead file found for sample %s" % sample_id)
+
+    probes, controls, is_snp = read_manifests(probes_file, controls_file)
 
-    controls_grn = pd.DataFrame(np.nan, index=controls.index, columns=np.sort(pd.unique(idat_files['sample.id'])))
-    controls_red = pd.DataFrame(np.nan, index=controls.index, columns=np.sort(pd.unique(idat_files['sample.id'])))
 
+    ## preparation of outputs
+    # row positions of each probe type from a single grouping pass over the type column,
+    # shared by all steps working on the (probes x samples) arrays
+    type_rows = probes.groupby('type', observed=True).indices
+    i_grn = type_rows['I-Grn']
+    i_red = type_rows['I-Red']
+    i_inf2 = type_rows['II']
 
     ##Separation of unmethylated and methylated intensities
     # Separate Grn/Red intensities into A (unmethylated) and B (methylated) intensities
-    # depending on their type
+    # depending on their type: type I probes have one bead address per allele,
+    # type II probes a single address read in both channels
 
-    ad_a_grn = (probes['address.a'].loc[probes['type'] == 'I-Grn'])
-    ad_b_grn = (probes['address.b'].loc[probes['type'] == 'I-Grn'])
-    ad_a_red = (probes['address.b'].loc[probes['type'] == 'I-Red'])
-    ad_b_red = (probes['address.b'].loc[probes['type'] == 'I-Red'])
-    ad_a_inf = (probes['address.a'].loc[probes['type'] == 'II'])
+    address_a = probes['address.a'].to_numpy()
+    address_b = probes['address.b'].to_numpy()
 
-    inf1grn = probes[probes['type'] == "I-Grn"].index
-    inf1red = probes[probes['type'] == "I-Red"].index
-    inf2 = probes[probes['type'] == "II"].index
+    ad_a_grn = address_a[i_grn]
+    ad_b_grn = address_b[i_grn]
+    ad_a_red = address_a[i_red]
+    ad_b_red = address_b[i_red]
+    ad_a_inf = address_a[i_inf2]
 
     con_ind = controls.index
-    sample_ids = np.sort(pd.unique(idat_files['sample.id']))
-
-
-    #loop over sample id index and fill out rows based on if value is in data
-
-    for column, data in zip(intensities_A, data_list):  
-        intensities_A[column].loc[inf1grn] = np.where(data.loc[ad_a_grn, 'grn_n'] >= min_beads, data.loc[ad_a_grn, 'grn_mean'], np.nan)
-        intensities_A[column].loc[inf1red] = np.where(data.loc[ad_a_red, 'red_n'] >= min_beads, data.loc[ad_a_red, 'red_mean'], np.nan)
-        intensities_A[column].loc[inf2] = np.where(data.loc[ad_a_inf, 'red_n'] >= min_beads, data.loc[ad_a_inf, 'red_mean'], np.nan)
-
-    
-    for column, data in zip(intensities_B, data_list):
-        intensities_B[column].loc[inf1grn] = np.where(data.loc[ad_b_grn, 'grn_n'] >= min_beads, data.loc[ad_b_grn, 'grn_mean'], np.nan)
-        intensities_B[column].loc[inf1red] = np.where(data.loc[ad_b_red, 'red_n'] >= min_beads, data.loc[ad_b_red, 'red_mean'], np.nan)
-        intensities_B[column].loc[inf2] = np.where(data.loc[ad_a_inf, 'grn_n'] >= min_beads, data.loc[ad_a_inf, 'grn_mean'], np.nan)
-
-
-
-    z = norm.ppf(1 - detection)
-
-    neg_means_grn_list = []
-    neg_sds_grn_list = []
-    threshold_inf1grn_list = []
 
-    for column, data in zip(controls_grn, data_list):
-        controls_grn[column].loc[con_ind] = np.where(data.loc[con_ind, 'grn_n'] > 0,
-                                                      data.loc[con_ind, 'grn_mean'],
-                                                      np.nan)
 
-        neg_beads_grn = controls[controls['type'] == "NEGATIVE"].index
-        neg_means_grn = (controls_grn[column].loc[neg_beads_grn]).mean()
-        neg_sds_grn = (controls_grn[column].loc[neg_beads_grn]).std(axis=0)
-        threshold_inf1grn = 2 * neg_means_grn + z * np.sqrt(2) * neg_sds_grn
-        neg_means_grn_list.append(neg_means_grn)
-        neg_sds_grn_list.append(neg_sds_grn)
-        threshold_inf1grn_list.append(threshold_inf1grn)
+    def bead_means(data, pos, channel, min_n):
+        # gather the means at the given row positions (-1 for absent addresses) of one sample,
+        # censoring means measured on less than min_n beads (absent addresses count as 0 beads);
+        # intensities are kept as float32, which is plenty for the 16 bit scanner values
+        # and halves the memory traffic of everything downstream
+        # (the gather already yields a fresh buffer, censored values are overwritten in place)
+        n = data[channel + '_n'][pos]
+        mean = data[channel + '_mean'][pos]
+        np.copyto(mean, np.float32(np.nan), where=(pos < 0) | (n < min_n))
+        return mean
+
+    # row-major buffers: every step below works on whole probe rows
+    A = np.full((len(probes), len(sample_ids)), np.nan, dtype=np.float32, order='C')
+    B = np.full((len(probes), len(sample_ids)), np.nan, dtype=np.float32, order='C')
+    controls_grn_arr = np.full((len(controls), len(sample_ids)), np.nan, dtype=np.float32, order='C')
+    controls_red_arr = np.full((len(controls), len(sample_ids)), np.nan, dtype=np.float32, order='C')
+
+    def address_rows(addresses):
+        # address -> row lookup of one bead file, giving the row positions of every
+        # address set (each looked up once and shared by both channels)
+        lookup = pd.Index(addresses)
+        return [lookup.get_indexer(ad) for ad in (ad_a_grn, ad_b_grn, ad_a_red, ad_b_red, ad_a_inf, con_ind)]
+
+    # bead files of the same array list their addresses in the same order, so the lookup is
+    # built once from the first file and reused for every sample with an identical layout
+    first_data = load_data(sample_bead_files[0])
+    reference_addresses = first_data['probe_address']
+    reference_rows = address_rows(reference_addresses)
+
+    def fill_sample(j, data):
+        # writes the bead data of sample j into column j of the buffers
+        if np.array_equal(data['probe_address'], reference_addresses):
+            pos_a_grn, pos_b_grn, pos_a_red, pos_b_red, pos_inf2, pos_con = reference_rows
+        else:
+            pos_a_grn, pos_b_grn, pos_a_red, pos_b_red, pos_inf2, pos_con = address_rows(data['probe_address'])
+
+        A[i_grn, j] = bead_means(data, pos_a_grn, 'grn', min_beads)
+        A[i_red, j] = bead_means(data, pos_a_red, 'red', min_beads)
+        A[i_inf2, j] = bead_means(data, pos_inf2, 'red', min_beads)
+
+        B[i_grn, j] = bead_means(data, pos_b_grn, 'grn', min_beads)
+        B[i_red, j] = bead_means(data, pos_b_red, 'red', min_beads)
+        B[i_inf2, j] = bead_means(data, pos_inf2, 'grn', min_beads)
+
+        controls_grn_arr[:, j] = bead_means(data, pos_con, 'grn', 1)
+        controls_red_arr[:, j] = bead_means(data, pos_con, 'red', 1)
+
+    def load_sample(j, bead_file):
+        # parses the bead file of sample j, fills its column and releases it
+        fill_sample(j, load_data(bead_file))
+
+    # the first sample is filled from the already parsed file
+    fill_sample(0, first_data)
+    del first_data
+
+    # samples are independent and every worker writes its own column of the shared
+    # buffers, so threads need no copies of the (probes x samples) arrays; only the
+    # bead tables currently being processed are in memory
+    with ThreadPoolExecutor(max_workers=max(1, min(len(sample_bead_files) - 1, os.cpu_count() or 1))) as executor:
+        list(executor.map(load_sample, range(1, len(sample_bead_files)), sample_bead_files[1:]))
+
+
+    # standard normal quantile of 1 - detection
+    z = math.sqrt(2) * erfinv(1 - 2 * detection)
+
+    # positions of the control beads of every type and description, grouped in a single
+    # pass over the table; all later selections are dictionary lookups
+    type_groups = controls.groupby('type', observed=True).indices
+    desc_groups = controls.groupby('description', observed=True).indices
+
+    def beads(groups, names):
+        # positions of the beads of several groups, in the order of the controls table;
+        # names absent from the manifest are skipped (e.g. 'BS Conversion I-U6' on EPIC arrays),
+        # statistics over an empty selection are missing
+        return np.sort(np.concatenate([groups.get(name, np.empty(0, dtype=np.intp)) for name in names]))
+
+    ## negative control beads, summarised per sample over all samples at once
+    neg_beads = type_groups['NEGATIVE']
+
+    neg_grn = controls_grn_arr[neg_beads]
+    neg_means_grn = np.nanmean(neg_grn, axis=0)
+    neg_sds_grn = np.nanstd(neg_grn, axis=0, ddof=1)
+    threshold_inf1grn = (2 * neg_means_grn + z * np.sqrt(2) * neg_sds_grn).astype(np.float32)
+
+    neg_red = controls_red_arr[neg_beads]
+    neg_means_red = np.nanmean(neg_red, axis=0)
+    neg_sds_red = np.nanstd(neg_red, axis=0, ddof=1)
+    threshold_inf1red = (2 * neg_means_red + z * np.sqrt(2) * neg_sds_red).astype(np.float32)
 
 
-    neg_means_red_list = []
-    neg_sds_red_list = []
-    threshold_inf1red_list = []
-
-    for column, data in zip(controls_red, data_list):
-        controls_red[column].loc[con_ind] = np.where(data.loc[con_ind, 'red_n'] > 0,
-                                                      data.loc[con_ind, 'red_mean'],
-                                                      np.nan)
-
-        neg_beads_red = controls[controls['type'] == "NEGATIVE"].index
-        neg_means_red = (controls_red[column].loc[neg_beads_red]).mean()
-        neg_sds_red = (controls_red[column].loc[neg_beads_red]).std(axis=0)
-        threshold_inf1red = 2 * neg_means_red + z * np.sqrt(2) * neg_sds_red
-
-        neg_means_red_list.append(neg_means_red)
-        neg_sds_red_list.append(neg_sds_red)
-        threshold_inf1red_list.append(threshold_inf1red)
-
-
-    threshold_inf2_list =[]
-
     ## Defining a threshold of detection
-    for x, y, j, i in zip(neg_means_grn_list, neg_means_red_list, neg_sds_grn_list, neg_sds_red_list):
-        neg_means_ = (x + y)
-        threshold_inf2 = neg_means_ + z * np.sqrt(j**2 + i**2 )
-        threshold_inf2_list.append(threshold_inf2)
-
-
-    # Censoring of values below the detection limit and background subtraction
-    # Background subtraction
-
-    I = pd.concat([intensities_A, intensities_B], axis=1)
-
-    for column in intensities_A:
-        I[column] = I[column].sum(axis=1) 
-
-    I = I.loc[:,~I.columns.duplicated()]
+    threshold_inf2 = (neg_means_grn + neg_means_red + z * np.hypot(neg_sds_grn, neg_sds_red)).astype(np.float32)
 
-    for column1, column2, x, y, z, a, b in zip(intensities_A, I, threshold_inf1grn_list, threshold_inf1red_list, threshold_inf2_list, neg_means_grn_list, neg_means_red_list):
 
-        intensities_A[column1].loc[inf1grn] = (np.where((intensities_A[column1].loc[inf1grn] > a) & (I[column2].loc[inf1grn] > x),
-                                                    (intensities_A[column1].loc[inf1grn] - a),
-                                                    np.nan))
+    # position of the (first) bead of every description
+    pos = {description: group[0] for description, group in desc_groups.items()}
 
-        intensities_A[column1].loc[inf1red] = (np.where((intensities_A[column1].loc[inf1red] > b) & (I[column2].loc[inf1red] > y),
-                                                    (intensities_A[column1].loc[inf1red] - b),
-                                                    np.nan))   
-
-        intensities_A[column1].loc[inf2] = (np.where((intensities_A[column1].loc[inf2] > b) & (I[column2].loc[inf2] > z),
-                                                    (intensities_A[column1].loc[inf2] - b),
-                                                    np.nan))
-    
-
-    for column1, column2, x, y, z, a, b in zip(intensities_B, I, threshold_inf1grn_list, threshold_inf1red_list, threshold_inf2_list, neg_means_grn_list, neg_means_red_list):
-
-        intensities_B[column1].loc[inf1grn] = (np.where((intensities_B[column1].loc[inf1grn] > a) & (I[column2].loc[inf1grn] > x),
-                                                    (intensities_B[column1].loc[inf1grn] - a),
-                                                    np.nan))
-
-        intensities_B[column1].loc[inf1red] = (np.where((intensities_B[column1].loc[inf1red] > b) & (I[column2].loc[inf1red] > y),
-                                                    (intensities_B[column1].loc[inf1red] - b),
-                                                    np.nan))   
-
-        intensities_B[column1].loc[inf2] = (np.where((intensities_B[column1].loc[inf2] > a) & (I[column2].loc[inf2] > z),
-                                                    (intensities_B[column1].loc[inf2] - a),
-                                                    np.nan))
-
-    
     # Extract normalization probes for Grn and Red, and form the dye bias correction constant
-    norm_grn_beads = controls[controls['type'].isin(['NORM_C', 'NORM_G'])].index
-    norm_red_beads1 = controls['description'].loc[norm_grn_beads].str.translate(str.maketrans('CG', 'TA')) 
-    norm_red_beads = controls[controls['description'].isin(norm_red_beads1)].index
-
-    corrections_grn_list = []
-    corrections_red_list = []
+    # (the red partner of each green normalization probe has the C -> T, G -> A translated
+    # description and is looked up in pos, which keeps the pairs aligned)
+    norm_grn_beads = beads(type_groups, ['NORM_C', 'NORM_G'])
+    partner = str.maketrans('CG', 'TA')
+    norm_red_beads = np.array([pos[description.translate(partner)]
+                               for description in controls['description'].iloc[norm_grn_beads]])
 
+    grn = controls_grn_arr[norm_grn_beads]
+    red = controls_red_arr[norm_red_beads]
+    # as in the R code missing values are skipped, both for the mean of each
+    # pair and for the average over the normalization probes
+    norm_data = np.nanmean(np.stack([grn, red]), axis=0)
 
-    for column1, column2 in zip(controls_grn, controls_red):
-        grn = controls_grn[column1].loc[norm_grn_beads].values
-        red = controls_red[column2].loc[norm_red_beads].values
-        
-        norm_data = pd.DataFrame([grn, red]).T
+    corrections_grn = np.nanmean(norm_data / grn, axis=0)
+    corrections_red = np.nanmean(norm_data / red, axis=0)
 
-        corrections_grn = (np.mean(norm_data,  axis=1)/ grn).mean(axis=0)
-        corrections_red = (np.mean(norm_data, axis=1)/ red).mean(axis=0)
 
-        corrections_grn_list.append(corrections_grn)
-        corrections_red_list.append(corrections_red)
+    # Censoring of values below the detection limit, background subtraction
+    # and dye bias correction (type II probes only), one fused pass per probe type
+    no_correction = np.ones(len(sample_ids), dtype=np.float32)
 
-
-    ## Apply dye bias correction
-    for column1, column2, x, y in zip(intensities_A, intensities_B, corrections_red_list, corrections_grn_list):
-        
-
-        intensities_A[column1].loc[inf2] = intensities_A[column1].loc[inf2] * x
-        intensities_B[column2].loc[inf2] = intensities_B[column2].loc[inf2] * y
+    correct_intensities(A, B, i_grn, neg_means_grn, neg_means_grn, threshold_inf1grn, no_correction, no_correction)
+    correct_intensities(A, B, i_red, neg_means_red, neg_means_red, threshold_inf1red, no_correction, no_correction)
+    correct_intensities(A, B, i_inf2, neg_means_red, neg_means_grn, threshold_inf2, corrections_red, corrections_grn)
 
 
     ## Computing DNA methylation ratios (β values)
@@ -285,172 +424,153 @@ def preprocess(probes_file, controls_file, idat_files_folder, min_beads=3, detec
 
     # Create DNAm ratios as B (methylated) over total
 
-    idx = probes[probes.index.str.startswith('rs')].index ##'rs10796216', 'rs715359',..
-
-    intensities = intensities_A.add(intensities_B, fill_value=0)
-    intensities.set_index(probes.index, inplace=True)
+    idx = probes.index[is_snp]
 
-    intensities_A_wo = intensities_A.index.isin(idx)
-    intensities_B_wo = intensities_B.index.isin(idx)
-    intensities_wo = intensities.index.isin(idx)
-    
- 
-    dnam = intensities_B[~intensities_B_wo] / np.sum(intensities[~intensities_wo])
+    # the total intensity buffer is reused for the ratio (NaN wherever A or B was censored)
+    is_cpg = ~is_snp
+    B_cpg = B[is_cpg]
+    dnam_arr = A[is_cpg]
+    np.add(dnam_arr, B_cpg, out=dnam_arr)
+    np.divide(B_cpg, dnam_arr, out=dnam_arr)
+    dnam = pd.DataFrame(dnam_arr, index=probes.index[is_cpg], columns=sample_ids, copy=False)
 
 
     ## SNPS
 
-    snps_theta = pd.DataFrame(np.nan, index=probes.loc[idx].index, columns=np.sort(pd.unique(idat_files['sample.id'])))
-    snps_r = pd.DataFrame(np.nan, index=probes.loc[idx].index, columns=np.sort(pd.unique(idat_files['sample.id'])))
-    
-    idx = probes[probes.index.str.contains('rs')].index
-    snps_theta[column] = np.arctan2(intensities_B[intensities_B_wo][column], intensities_A[intensities_A_wo][column])/ (np.pi/2)
-    snps_r[column] = np.sqrt(np.sum(intensities.loc[idx]**2))
-
-    ### matching 
-    # Extract all control probes data, and add summary statistics to samples table
-
-    summary = pd.DataFrame(np.nan, columns=np.sort(pd.unique(idat_files['sample.id'])), 
-        index=['bc1_grn', 'bc1_red', 'bc2', 'ext_a', 'ext_c', 'ext_g', 'ext_t',
-                'hyp_low', 'hyp_med', 'hyp_high', 'np_a', 'np_c',
-                'np_g', 'np_t', 'spec1_grn', 'spec1_red', 'spec2', 'st_grn', 'st_red',
-                'tr', 'missing', 'median_chrX', 'missing_chrY'])
-
-    for column in summary:
-
-        # match 1
+    # the SNP rows are gathered once and shared by both formats
+    A_rs = A[is_snp]
+    B_rs = B[is_snp]
 
-        bg = ['BS Conversion I-U1', 'BS Conversion I-U2','BS Conversion I-U3']
-        idx_bg = (controls[controls['description'].str.contains('|'.join(bg))]).index
-        match_ = controls['description'].loc[idx_bg].str.translate(str.maketrans('U', 'C'))
-        idx_signal = controls['description'].isin(match_)
-        new_ind = controls_grn[idx_signal].index
-        summary[column].loc['bc1_grn'] = (np.nanmean(controls_grn[column].loc[new_ind])/np.mean(controls_grn[column].loc[idx_bg]))
+    # theta format, scaled in place
+    theta = np.arctan2(B_rs, A_rs, out=np.empty_like(A_rs))
+    theta *= 2 / np.pi
+    snps_theta = pd.DataFrame(theta, index=idx, columns=sample_ids, copy=False)
 
-        bg = ['BS Conversion I-U4', 'BS Conversion I-U5','BS Conversion I-U6']
-        idx_bg = (controls[controls['description'].str.contains('|'.join(bg))]).index
-        match_ = controls['description'].loc[idx_bg].str.translate(str.maketrans('U', 'C'))
-        idx_signal = controls['description'].isin(match_)
-        new_ind = controls_red[idx_signal].index
-        summary[column].loc['bc1_red'] = (np.nanmean(controls_red[column].loc[new_ind])/np.mean(controls_red[column].loc[idx_bg]))
+    # r format, sqrt(A**2 + B**2) per SNP and sample in one fused pass
+    snps_r = pd.DataFrame(np.hypot(A_rs, B_rs), index=idx, columns=sample_ids, copy=False)
 
-        idx = controls[controls['type'] == 'BISULFITE CONVERSION II'].index
-        summary[column].loc['bc2'] = np.nanmean(controls_red[column].loc[idx]/np.nanmean(controls_grn[column].loc[idx]))
+    ### matching 
+    # Extract all control probes data, and add summary statistics to samples table
 
-        idd = controls[controls['description'] == 'Extension (A)'].index
-        summary[column].loc['ext_a'] = controls_red[column].loc[idd].values
-        
-        idd = controls[controls['description'] == "Extension (C)"].index
-        summary[column].loc['ext_c'] = controls_grn[column].loc[idd].values 
+    # the statistics are collected as one array per row and assembled into a dataframe at the end
+    summary_rows = ['bc1_grn', 'bc1_red', 'bc2', 'ext_a', 'ext_c', 'ext_g', 'ext_t',
+                    'hyp_low', 'hyp_med', 'hyp_high', 'np_a', 'np_c',
+                    'np_g', 'np_t', 'spec1_grn', 'spec1_red', 'spec2', 'st_grn', 'st_red',
+                    'tr', 'missing', 'median_chrX', 'missing_chrY']
+    summary = {row: np.full(len(sample_ids), np.nan) for row in summary_rows}
 
-        idd = controls[controls['description'] == 'Extension (G)'].index
-        summary[column].loc['ext_g'] = controls_grn[column].loc[idd].values
+    # row positions of the control beads are taken from the type and description
+    # groups and used to index the (controls x samples) arrays
 
-        idd = controls[controls['description'] == 'Extension (T)'].index
-        summary[column].loc['ext_t'] = controls_red[column].loc[idd].values
-        
-        idd = controls[controls['description'] == 'Hyb (Low)'].index
-        summary[column].loc['hyp_low'] = controls_grn[column].loc[idd].values 
+    # match 1
+    # (as in the R code the signal beads are the partners of the background beads present
+    # in the manifest, a missing background bead also drops its partner)
 
-        idd = controls[controls['description'] == 'Hyb (Medium)'].index
-        summary[column].loc['hyp_med'] = controls_grn[column].loc[idd].values 
+    bg = ['BS Conversion I-U1', 'BS Conversion I-U2','BS Conversion I-U3']
+    match_ = [description.replace('U', 'C') for description in bg if description in desc_groups]
+    bc1_grn_bg = beads(desc_groups, bg)
+    bc1_grn_signal = beads(desc_groups, match_)
 
-        idd = controls[controls['description'] == 'Hyb (High)'].index
-        summary[column].loc['hyp_high'] = controls_grn[column].loc[idd].values 
+    bg = ['BS Conversion I-U4', 'BS Conversion I-U5','BS Conversion I-U6']
+    match_ = [description.replace('U', 'C') for description in bg if description in desc_groups]
+    bc1_red_bg = beads(desc_groups, bg)
+    bc1_red_signal = beads(desc_groups, match_)
 
-        idd = controls[controls['description'] == 'NP (A)'].index
-        summary[column].loc['np_a'] = controls_red[column].loc[idd].values 
+    bc2 = type_groups['BISULFITE CONVERSION II']
 
-        idd = controls[controls['description'] == 'NP (C)'].index
-        summary[column].loc['np_c'] = controls_grn[column].loc[idd].values 
 
-        idd = controls[controls['description'] == 'NP (G)'].index
-        summary[column].loc['np_g'] = controls_grn[column].loc[idd].values 
+    # match 2
 
-        idd = controls[controls['description'] == 'NP (T)'].index
-        summary[column].loc['np_t'] = controls_red[column].loc[idd].values 
+    bg = ['GT Mismatch 1 (MM)', 'GT Mismatch 2 (MM)', 'GT Mismatch 3 (MM)']
+    signal = [description.replace('MM', 'PM') for description in bg if description in desc_groups]
+    spec1_grn_bg = beads(desc_groups, bg)
+    spec1_grn_signal = beads(desc_groups, signal)
 
-        # match 2
+    bg = ['GT Mismatch 4 (MM)', 'GT Mismatch 5 (MM)', 'GT Mismatch 6 (MM)']
+    signal = [description.replace('MM', 'PM') for description in bg if description in desc_groups]
+    spec1_red_bg = beads(desc_groups, bg)
+    spec1_red_signal = beads(desc_groups, signal)
 
-        controls[controls['description'] == 'GT Mismatch 1 (MM)'] = 'gt_mismatch_1_mm'
-        controls[controls['description'] == 'GT Mismatch 2 (MM)'] = 'gt_mismatch_2_mm'
-        controls[controls['description'] == 'GT Mismatch 3 (MM)'] = 'gt_mismatch_3_mm'
-        bg = ['gt_mismatch_1_mm', 'gt_mismatch_2_mm', 'gt_mismatch_3_mm']
-        idx_bg = controls[controls['description'].str.contains('|'.join(bg))].index
+    spec2 = type_groups['SPECIFICITY II']
 
-        controls[controls['description'] == 'GT Mismatch 1 (PM)'] = 'gt_mismatch_1_pm'
-        controls[controls['description'] == 'GT Mismatch 2 (PM)'] = 'gt_mismatch_2_pm'
-        controls[controls['description'] == 'GT Mismatch 3 (PM)'] = 'gt_mismatch_3_pm'
-        signal = ['gt_mismatch_1_pm', 'gt_mismatch_2_pm', 'gt_mismatch_3_pm']
-        idx_signal = controls[controls['description'].str.contains('|'.join(signal))].index
+    # match 5
+    tr = type_groups['TARGET REMOVAL']
 
-        summary[column].loc['spec1_grn'] = (np.nanmean(controls_grn[column].loc[idx_signal])/np.mean(controls_grn[column].loc[idx_bg]))
+    # match 6
+    # (the dnam rows are the probes without the SNPs, in the same order)
+    chr_cpg = probes['chr'].to_numpy()[is_cpg]
+    chr_x = np.flatnonzero(chr_cpg == 'X')
+    chr_y = np.flatnonzero(chr_cpg == 'Y')
 
-    
-        controls[controls['description'] == 'GT Mismatch 4 (MM)'] = 'gt_mismatch_4_mm'
-        controls[controls['description'] == 'GT Mismatch 5 (MM)'] = 'gt_mismatch_5_mm'
-        controls[controls['description'] == 'GT Mismatch 6 (MM)'] = 'gt_mismatch_6_mm'
-        bg = ['gt_mismatch_4_', 'gt_mismatch_5_', 'gt_mismatch_6_']
-        idx_bg = controls[controls['description'].str.contains('|'.join(bg))].index
+    # every statistic is reduced over its control beads for all samples at once
+    G = controls_grn_arr
+    R = controls_red_arr
 
-        controls[controls['description'] == 'GT Mismatch 4 (PM)'] = 'gt_mismatch_4_pm'
-        controls[controls['description'] == 'GT Mismatch 5 (PM)'] = 'gt_mismatch_5_pm'
-        controls[controls['description'] == 'GT Mismatch 6 (PM)'] = 'gt_mismatch_6_pm'
-        signal = ['gt_mismatch_4_pm', 'gt_mismatch_5_pm', 'gt_mismatch_6_pm']
-        idx_signal = controls[controls['description'].str.contains('|'.join(signal))].index
+    # match 1
+    summary['bc1_grn'] = np.nanmean(G[bc1_grn_signal], axis=0) / np.mean(G[bc1_grn_bg], axis=0)
+    summary['bc1_red'] = np.nanmean(R[bc1_red_signal], axis=0) / np.mean(R[bc1_red_bg], axis=0)
+    summary['bc2'] = np.nanmean(R[bc2] / np.nanmean(G[bc2], axis=0), axis=0)
 
-        summary[column].loc['spec1_red'] = (np.nanmean(controls_red[column].loc[idx_signal])/np.mean(controls_red[column].loc[idx_bg]))
+    for description, (row, channel) in DESC_TO_ROW.items():
+        summary[row] = (G if channel == 'grn' else R)[pos[description]]
 
+    # match 2
+    summary['spec1_grn'] = np.nanmean(G[spec1_grn_signal], axis=0) / np.mean(G[spec1_grn_bg], axis=0)
+    summary['spec1_red'] = np.nanmean(R[spec1_red_signal], axis=0) / np.mean(R[spec1_red_bg], axis=0)
+    summary['spec2'] = np.nanmean(R[spec2], axis=0) / np.mean(G[spec2], axis=0)
 
-        idx = controls[controls['type'] == 'SPECIFICITY II'].index
-        summary[column].loc['spec2'] = (np.nanmean(controls_red[column].loc[idx])/np.mean(controls_grn[column].loc[idx]))
+    # match 3
+    summary['st_grn'] = G[pos['Biotin (High)']] / G[pos['Biotin (Bkg)']]
 
-        # match 3 
-        idx_bg = controls[controls['description'] == ('Biotin (Bkg)')].index
-        idx_signal = controls[controls['description'] == ('Biotin (High)')].index
-        summary[column].loc['st_grn'] = controls_grn[column].loc[idx_signal].values / controls_grn[column].loc[idx_bg].values
+    # match 4
+    summary['st_red'] = R[pos['DNP (High)']] / R[pos['DNP (Bkg)']]
 
-        # match 4
-        idx_bg = controls[controls['description'] == ('DNP (Bkg)')].index
-        idx_signal = controls[controls['description'] == ('DNP (High)')].index
-        summary[column].loc['st_red'] = controls_red[column].loc[idx_signal].values / controls_red[column].loc[idx_bg].values
-        
-        # match 5
-        idx = controls[controls['type'] == ('TARGET REMOVAL')].index
-        summary[column].loc['tr'] = np.nanmax(controls_grn[column].loc[idx], axis=0)
-        #summary[column].loc['missing'] = (dnam[column].isna().sum()) / len(dnam)
+    # match 5
+    summary['tr'] = np.nanmax(G[tr], axis=0)
+    #summary['missing'] = dnam.isna().mean()
 
-        # match 6
-        idx = probes[probes['chr'] == 'X'].index
-        summary[column].loc['median_chrX'] = np.nanmedian(dnam[column].loc[idx])
+    # match 6
+    summary['median_chrX'] = np.nanmedian(dnam_arr[chr_x], axis=0)
+    ## less missing values as in R code? 
+    summary['missing_chrY'] = np.isnan(dnam_arr[chr_y]).mean(axis=0)
 
-        idy = probes[probes['chr'] == 'Y'].index
-        ## less missing values as in R code? 
-        #print ("missing values dnam per column")
-        #print (dnam[column].loc[idy].isna().sum())
-        summary[column].loc['missing_chrY'] = dnam[column].loc[idy].isna().mean()
+    summary = pd.DataFrame(np.array([summary[row] for row in summary_rows], dtype=np.float64),
+                           index=summary_rows, columns=sample_ids)
 
 
-        ## 
     #cpgs = pd.read_csv("CH3/python/testing/cpgs.csv",index_col='Unnamed: 0', engine='c')
 
-
-    samples = summary.T
-    cpgs = dnam.T
-    snps = snps_theta.T
-
-
-    if return_intensities == True:
-        return samples, cpgs, snps, intensities_A, intensities_B, controls_red, controls_grn
-
-    elif return_snps_r == True:
-
-        snps_r = np.sqrt(np.sum(intensities[idx]**2))
-        
-        return snps_r
-
-    else:
-        return samples, cpgs, snps
+    ## the arrays are only wrapped into dataframes once all computations are done
+    ## (without copying, the buffers are not touched afterwards)
+    intensities_A = pd.DataFrame(A, index=probes.index, columns=sample_ids, copy=False)
+    intensities_B = pd.DataFrame(B, index=probes.index, columns=sample_ids, copy=False)
+
+    controls_grn = pd.DataFrame(controls_grn_arr, index=con_ind, columns=sample_ids, copy=False)
+    controls_red = pd.DataFrame(controls_red_arr, index=con_ind, columns=sample_ids, copy=False)
+
+    results = {'summary': summary, 'dnam': dnam, 'snps_theta': snps_theta, 'snps_r': snps_r,
+               'intensities_A': intensities_A, 'intensities_B': intensities_B,
+               'controls_red': controls_red, 'controls_grn': controls_grn}
+
+    if cache_dir is not None:
+        # frames are stored with samples as columns, wide (samples x probes) parquet files are very slow;
+        # they are written into a temporary folder that is renamed onto the key folder once all
+        # files are complete, so an interrupted or concurrent run never leaves a partial cache
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        tmp_path = tempfile.mkdtemp(prefix=key + '.', suffix='.tmp', dir=os.path.dirname(cache_path))
+        try:
+            for name in result_names:
+                results[name].to_parquet(os.path.join(tmp_path, name + '.parquet'), compression='zstd')
+            try:
+                os.replace(tmp_path, cache_path)
+            except OSError:
+                # another run has completed the same key in the meantime, its files are kept
+                if not os.path.isdir(cache_path):
+                    raise
+        finally:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+    return collect(results)
 
 
 